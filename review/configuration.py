@@ -3,10 +3,20 @@ Constants are stored here for use in other parts of the XBlock.
 '''
 from __future__ import absolute_import
 from django.conf import settings
+from opaque_keys.edx.keys import CourseKey
+
+
+def _key_by_course_key(mapping):
+    '''
+    Parses the course id keys of a mapping into CourseKeys so lookups can be
+    done with the course key directly instead of converting it to a string.
+    '''
+    return {CourseKey.from_string(course_id): value for course_id, value in mapping.items()}
+
 
 # Needed for review.py #
 # Eventually, this should be part of the XBlock fields as a Boolean
-SHOW_PROBLEMS = set([
+SHOW_PROBLEMS = frozenset([
     # This is here for testing purposes. Do not remove
     'DillonX/DAD101x/3T2017',
     # Anant's course
@@ -18,7 +28,7 @@ SHOW_PROBLEMS = set([
     # Quantum Information Science, Part 3
     'course-v1:MITx+8.370.3x+1T2018',
 ])
-SHOW_VERTICAL = set([
+SHOW_VERTICAL = frozenset([
 ])
 
 # Needed for get_review_ids.py #
@@ -27,9 +37,10 @@ The mappings here are necessary to grab the review content from a review
 version of the course (a copy where problems are not graded and have
 unlimited attempts).
 When accessed, the key is the course the learner is currently interacting
-with and the value is the corresponding review course.
+with and the value is the corresponding review course. The keys are parsed
+into CourseKeys at import time.
 '''
-REVIEW_COURSE_MAPPING = {
+REVIEW_COURSE_MAPPING = _key_by_course_key({
     # Course used for testing. DO NOT REMOVE
     'DillonX/DAD101x/3T2017': 'DillonX/DAD101x_review/3T2017',
     # Anant's course
@@ -40,8 +51,8 @@ REVIEW_COURSE_MAPPING = {
     'course-v1:MITx+8.370.2x+1T2018': 'MITx+8.370.2x_review+1T2018',
     # Quantum Information Science, Part 3
     'course-v1:MITx+8.370.3x+1T2018': 'MITx+8.370.3x_review+1T2018',
-}
-ENROLLMENT_COURSE_MAPPING = {
+})
+ENROLLMENT_COURSE_MAPPING = _key_by_course_key({
     # Course used for testing. DO NOT REMOVE
     'DillonX/DAD101x/3T2017': 'DillonX/DAD101x_review/3T2017',
     # Anant's course
@@ -52,5 +63,8 @@ ENROLLMENT_COURSE_MAPPING = {
     'course-v1:MITx+8.370.2x+1T2018': 'course-v1:MITx+8.370.2x_review+1T2018',
     # Quantum Information Science, Part 3
     'course-v1:MITx+8.370.3x+1T2018': 'course-v1:MITx+8.370.3x_review+1T2018',
-}
+})
+# Number of seconds to remember that a learner is actively enrolled in the
+# review version of a course before checking the enrollment API again
+ENROLLMENT_CACHE_TIMEOUT = 60 * 60
 XBLOCK_VIEW_URL_TEMPLATE = settings.LMS_ROOT_URL + '/xblock/block-v1:{course_id}+type@{type}+block@{xblock_id}'
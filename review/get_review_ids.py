@@ -18,16 +18,26 @@ from datetime import datetime
 
 import pytz
 import crum
+from django.core.cache import cache
 from courseware.models import StudentModule
 from enrollment.api import add_enrollment, get_enrollment, update_enrollment
 from lms.djangoapps.course_blocks.api import get_course_blocks
 from lms.djangoapps.grades.transformer import GradesTransformer
 from xmodule.modulestore.django import modulestore
 
-from .configuration import ENROLLMENT_COURSE_MAPPING, REVIEW_COURSE_MAPPING, XBLOCK_VIEW_URL_TEMPLATE
+from .configuration import (
+    ENROLLMENT_CACHE_TIMEOUT,
+    ENROLLMENT_COURSE_MAPPING,
+    REVIEW_COURSE_MAPPING,
+    XBLOCK_VIEW_URL_TEMPLATE
+)
 
 log = logging.getLogger(__name__)
 
+# Name of the attribute on the current request used to cache values that
+# are expensive to compute and are needed more than once per request
+REVIEW_REQUEST_CACHE_ATTR = '_review_xblock_cache'
+
 # TODO: Switch to using CourseLocators and/or CourseKeys everywhere
 
 
@@ -43,34 +53,23 @@ def get_problems(num_desired, current_course):
 
     Returns a list of num_desired tuples in the form (URL to display, correct, attempts)
     '''
-    user = crum.get_current_user()
-
-    enroll_user_in_review_course_if_needed(user, current_course)
-
-    store = modulestore()
-    course_usage_key = store.make_course_usage_key(current_course)
-    course_blocks = get_course_blocks(user, course_usage_key)
-
-    problem_data = []
+    user, _, valid_records = prepare_review_context(current_course)
 
-    for block_key, state in get_records(user, current_course):
-        block_key = block_key.replace(course_key=store.fill_in_run(block_key.course_key))
-        if is_valid_problem(store, block_key, state, course_blocks):
-            correct, attempts = get_correctness_and_attempts(state)
-            problem_id = block_key.block_id
-            problem_data.append((problem_id, correct, attempts))
-            delete_state_of_review_problem(user, current_course, problem_id)
+    review_problem_ids = [block_key.block_id for block_key, _, _ in valid_records]
+    delete_state_of_review_problems(user, current_course, review_problem_ids)
 
-    if len(problem_data) < num_desired:
+    if len(valid_records) < num_desired:
         return []
 
-    problems_to_show = random.sample(problem_data, num_desired)
-    review_course_id = REVIEW_COURSE_MAPPING[str(current_course)]
-    problem_information = []
-    for problem, correct, attempts in problems_to_show:
-        problem_information.append((XBLOCK_VIEW_URL_TEMPLATE.format(course_id=review_course_id,
-                                    type='problem', xblock_id=problem), correct, attempts))
-    return problem_information
+    problems_to_show = random.sample(valid_records, num_desired)
+    # URLs are only built for the problems that will be shown, not for every candidate.
+    # Problems with no recorded attempts are shown as having 0 attempts.
+    review_course_id = REVIEW_COURSE_MAPPING[current_course]
+    return [
+        (XBLOCK_VIEW_URL_TEMPLATE.format(course_id=review_course_id, type='problem', xblock_id=block_key.block_id),
+         correct, attempts or 0)
+        for block_key, correct, attempts in problems_to_show
+    ]
 
 
 def get_vertical(current_course):
@@ -84,66 +83,178 @@ def get_vertical(current_course):
 
     Returns a url (str) with the vertical id to render for review.
     '''
+    user, course_blocks, valid_records = prepare_review_context(current_course)
+
+    # Verticals are kept in a list (deduplicated through a set) so one can be
+    # picked with random.choice, which does not support sets
+    vertical_data = []
+    seen_verticals = set()
+    vertical_for = {}
+    review_problem_ids = []
+
+    for block_key, _, _ in valid_records:
+        # If the block_key does not have a subsection (sequential) in it's tree,
+        # we should skip it.
+        subsection = course_blocks.get_transformer_block_field(
+            block_key,
+            GradesTransformer,
+            'subsections',
+            set(),
+        )
+        if subsection:
+            try:
+                parent = course_blocks.get_parents(block_key)[0]
+            # The problem has no parent in the block structure so there is
+            # no vertical to show for it
+            except IndexError:
+                continue
+            # Sibling problems share the same parent so the walk up to the
+            # vertical only has to be done once per parent
+            if parent not in vertical_for:
+                vertical_for[parent] = get_parent_vertical(course_blocks, parent)
+            vertical = vertical_for[parent]
+            if vertical is None:
+                continue
+
+            if vertical.block_id not in seen_verticals:
+                seen_verticals.add(vertical.block_id)
+                vertical_data.append(vertical.block_id)
+            review_problem_ids.append(block_key.block_id)
+
+    delete_state_of_review_problems(user, current_course, review_problem_ids)
+
+    if not vertical_data:
+        return []
+
+    vertical_to_show = random.choice(vertical_data)
+    review_course_id = REVIEW_COURSE_MAPPING[current_course]
+    return (XBLOCK_VIEW_URL_TEMPLATE.format(course_id=review_course_id,
+                                            type='vertical', xblock_id=vertical_to_show))
+
+
+def prepare_review_context(current_course):
+    '''
+    Does the setup shared by get_problems and get_vertical: makes sure the
+    learner is enrolled in the review course, loads the blocks accessible
+    to them and filters the problems they have loaded down to the ones
+    that are valid to show as review.
+
+    Parameters:
+        current_course (CourseLocator): The course the learner is currently in
+
+    Returns a tuple of (user, course_blocks, valid_records)
+        user (User): the current user interacting with the review XBlock
+        course_blocks (BlockStructureBlockData): The blocks accessible to the learner
+        valid_records (list): (block_key, correct, attempts) tuples for each valid problem
+    '''
     user = crum.get_current_user()
 
     enroll_user_in_review_course_if_needed(user, current_course)
 
     store = modulestore()
-    course_usage_key = store.make_course_usage_key(current_course)
-    course_blocks = get_course_blocks(user, course_usage_key)
-
-    vertical_data = set()
-
-    for block_key, state in get_records(user, current_course):
-        block_key = block_key.replace(course_key=store.fill_in_run(block_key.course_key))
-        if is_valid_problem(store, block_key, state, course_blocks):
-            # If the block_key does not have a subsection (sequential) in it's tree,
-            # we should skip it.
-            subsection = course_blocks.get_transformer_block_field(
-                block_key,
-                GradesTransformer,
-                'subsections',
-                set(),
-            )
-            if subsection:
-                try:
-                    vertical = course_blocks.get_parents(block_key)[0]
-                    sequential = course_blocks.get_parents(vertical)[0]
-                    # This is in case the direct parent of a problem is not a vertical,
-                    # we want to keep looking until we find the parent vertical to display.
-                    # For example, you may see:
-                    # sequential -> vertical -> split_test -> problem
-                    # OR
-                    # sequential -> vertical -> vertical -> problem
-                    # OR
-                    # sequential -> vertical -> conditional_block -> problem
-                    while sequential.block_type != 'sequential' and vertical.block_type != 'vertical':
-                        vertical = sequential
-                        sequential = course_blocks.get_parents(vertical)[0]
-                # Catches IndexError for the case where the parent we are looking for
-                # is not the first element returned in get_parents. This can lead to
-                # looking in a part of the tree that does not include what we want. In
-                # this case, we will just skip the problem.
-                except IndexError:
-                    continue
-
-                vertical_data.add(vertical.block_id)
-                delete_state_of_review_problem(user, current_course, block_key.block_id)
+    course_blocks = get_cached_course_blocks(store, user, current_course)
+
+    # All of the records belong to the current course so the run only has to
+    # be filled in once rather than for every block key
+    course_key = store.fill_in_run(current_course)
+    records = [
+        (block_key.map_into_course(course_key), correct, attempts)
+        for block_key, correct, attempts in get_records(user, current_course)
+    ]
+
+    now = datetime.now(pytz.utc)
+    valid_records = []
+    unresolved_records = []
+    for record in records:
+        block_key, correct, _ = record
+        # The problem has to be accessible to the learner to be shown at all
+        if block_key not in course_blocks:
+            continue
+        if is_valid_problem(correct, course_blocks, block_key, now):
+            valid_records.append(record)
+        else:
+            unresolved_records.append(record)
+
+    # Only the problems that are not already valid need their instance from
+    # the modulestore to check if all of the attempts have been used
+    problems = get_problem_descriptors(store, current_course, unresolved_records)
+    valid_records.extend(
+        (block_key, correct, attempts)
+        for block_key, correct, attempts in unresolved_records
+        if has_used_all_attempts(problems.get(block_key.block_id), attempts)
+    )
+    return user, course_blocks, valid_records
+
+
+def get_parent_vertical(course_blocks, parent):
+    '''
+    Walks up the course tree from the parent of a problem until it finds
+    the vertical that should be displayed for the problem.
 
-    if not vertical_data:
-        return []
+    Parameters:
+        course_blocks (BlockStructureBlockData): The blocks accessible to the learner
+        parent (opaque_keys.edx.locator.BlockUsageLocator): The direct parent of a problem
 
-    vertical_to_show = random.sample(vertical_data, 1)[0]
-    review_course_id = REVIEW_COURSE_MAPPING[str(current_course)]
-    return (XBLOCK_VIEW_URL_TEMPLATE.format(course_id=review_course_id,
-                                            type='vertical', xblock_id=vertical_to_show))
+    Returns the locator for the vertical, or None if it could not be found
+    '''
+    vertical = parent
+    try:
+        sequential = course_blocks.get_parents(vertical)[0]
+        # This is in case the direct parent of a problem is not a vertical,
+        # we want to keep looking until we find the parent vertical to display.
+        # For example, you may see:
+        # sequential -> vertical -> split_test -> problem
+        # OR
+        # sequential -> vertical -> vertical -> problem
+        # OR
+        # sequential -> vertical -> conditional_block -> problem
+        while sequential.block_type != 'sequential' and vertical.block_type != 'vertical':
+            vertical = sequential
+            sequential = course_blocks.get_parents(vertical)[0]
+    # Catches IndexError for the case where the parent we are looking for
+    # is not the first element returned in get_parents. This can lead to
+    # looking in a part of the tree that does not include what we want. In
+    # this case, we will just skip the problem.
+    except IndexError:
+        return None
+    return vertical
+
+
+def get_cached_course_blocks(store, user, current_course):
+    '''
+    Returns the blocks of the course accessible to the user. Building the
+    block structure is expensive so the result is cached on the current
+    request and reused if it is needed again while handling that request.
+
+    Parameters:
+        store (xmodule.modulestore.mixed.MixedModuleStore): Modulestore
+            for creating the usage key of the course
+        user (User): the current user interacting with the review XBlock
+        current_course (CourseLocator): The course the learner is currently in
+
+    Returns the BlockStructureBlockData for the course
+    '''
+    # Outside of a request (e.g. in a shell) nothing is cached
+    request_cache = {}
+    request = crum.get_current_request()
+    if request is not None:
+        if not hasattr(request, REVIEW_REQUEST_CACHE_ATTR):
+            setattr(request, REVIEW_REQUEST_CACHE_ATTR, {})
+        request_cache = getattr(request, REVIEW_REQUEST_CACHE_ATTR)
+
+    cache_key = ('course_blocks', user.id, current_course)
+    if cache_key not in request_cache:
+        course_usage_key = store.make_course_usage_key(current_course)
+        request_cache[cache_key] = get_course_blocks(user, course_usage_key)
+    return request_cache[cache_key]
 
 
 def get_records(user, current_course):
     '''
     Generator that yields each applicable record from the Courseware Student
     Module. Each record corresponds to a problem the user has loaded
-    in the original course.
+    in the original course. The state of each record is parsed once here
+    so the callers only deal with the values derived from it.
 
     Parameters:
         user (django.contrib.auth.models.User): User object for the current user
@@ -152,17 +263,49 @@ def get_records(user, current_course):
     Returns:
         record.module_state_key (opaque_keys.edx.locator.BlockUsageLocator):
             The locator for the problem
-        state (dict): The state of the problem
+        correct (Bool): True if correct, False if incorrect, None if there is no score
+        attempts (int): None if no attempts were recorded, else number of times attempted
     '''
+    # StudentModule and its indexes are owned by edx-platform. This filter is
+    # served by the (student, module_state_key, course_id) unique index, whose
+    # leading student column narrows the rows down to a single learner.
     problem_filter = {'student_id': user.id, 'course_id': current_course, 'module_type': 'problem'}
-    for record in StudentModule.objects.filter(**problem_filter):
+    # Only the columns used below are loaded and the rows are streamed from the
+    # database cursor instead of being cached on the queryset all at once
+    records = StudentModule.objects.filter(**problem_filter).only('module_state_key', 'state')
+    for record in records.iterator():
         state = json.loads(record.state)
         # The key 'selected' shows up if a problem comes from a
         # library content module. These cause issues so we skip this.
         # Issue: Library content contains problems but the CSM brings up
         # the library content and not the problems within
         if 'selected' not in state:
-            yield record.module_state_key, state
+            correct, attempts = get_correctness_and_attempts(state)
+            yield record.module_state_key, correct, attempts
+
+
+def get_problem_descriptors(store, current_course, records):
+    '''
+    Fetches the problem instances for all of the records in a single trip to
+    the modulestore instead of calling get_item once per record.
+
+    Parameters:
+        store (xmodule.modulestore.mixed.MixedModuleStore): Modulestore
+            for grabbing the instances of the problems
+        current_course (CourseLocator): The course the learner is currently in
+        records (list): (block_key, correct, attempts) tuples returned from get_records
+
+    Returns a dict mapping each problem id (str) to its problem instance
+    '''
+    problem_ids = set(block_key.block_id for block_key, _, _ in records)
+    if not problem_ids:
+        return {}
+
+    return {
+        problem.location.block_id: problem
+        for problem in store.get_items(current_course, qualifiers={'category': 'problem'})
+        if problem.location.block_id in problem_ids
+    }
 
 
 def enroll_user_in_review_course_if_needed(user, current_course):
@@ -175,38 +318,47 @@ def enroll_user_in_review_course_if_needed(user, current_course):
         user (User): the current user interacting with the review XBlock
         current_course (CourseLocator): The course the learner is currently in
     '''
-    enrollment_course_id = ENROLLMENT_COURSE_MAPPING[str(current_course)]
+    enrollment_course_id = ENROLLMENT_COURSE_MAPPING[current_course]
+    # Once the learner is known to be actively enrolled, the enrollment API
+    # is skipped until the cache entry expires
+    cache_key = 'review_xblock.enrolled.{user_id}.{course_id}'.format(
+        user_id=user.id,
+        course_id=enrollment_course_id,
+    )
+    if cache.get(cache_key):
+        return
+
     enrollment_status = get_enrollment(user.username, enrollment_course_id)
     if not enrollment_status:
         add_enrollment(user.username, enrollment_course_id)
     elif not enrollment_status['is_active']:
         update_enrollment(user.username, enrollment_course_id, is_active=True)
+    cache.set(cache_key, True, ENROLLMENT_CACHE_TIMEOUT)
 
 
-def delete_state_of_review_problem(user, current_course, problem_id):
+def delete_state_of_review_problems(user, current_course, problem_ids):
     '''
-    Deletes the state of a review problem so it can be used infinitely
-    many times.
+    Deletes the state of the review problems so they can be used infinitely
+    many times. This is done in a single query rather than once per problem.
 
     Parameters:
         user (User): the current user interacting with the review XBlock
         current_course (CourseLocator): The course the learner is currently in
-        problem_id (str): The problem id whose state should be cleared
+        problem_ids (list): The problem ids (str) whose state should be cleared
     '''
+    if not problem_ids:
+        return
+
     review_course = current_course.replace(course=current_course.course+'_review')
-    review_key = review_course.make_usage_key('problem', problem_id)
-    try:
-        module_to_delete = StudentModule.objects.get(
-            student_id=user.id,
-            course_id=review_course,
-            module_state_key=review_key
-        )
-        module_to_delete.delete()
-    except StudentModule.DoesNotExist:
-        # The record will not exist in the StudentModule if the learner has not
-        # seen it as a review problem yet so we just want to skip since there
-        # is no state to delete
-        pass
+    review_keys = [review_course.make_usage_key('problem', problem_id) for problem_id in problem_ids]
+    # Records will not exist in the StudentModule for problems the learner has
+    # not seen as a review problem yet. Those are simply not matched by the
+    # filter so there is nothing to special case.
+    StudentModule.objects.filter(
+        student_id=user.id,
+        course_id=review_course,
+        module_state_key__in=review_keys
+    ).delete()
 
 
 def get_correctness_and_attempts(state):
@@ -219,23 +371,20 @@ def get_correctness_and_attempts(state):
         state (dict): The state of a problem
 
     Returns a tuple of (correct, attempts)
-        correct (Bool): True if correct, else False
-        attempts (int): 0 if never attempted, else number of times attempted
+        correct (Bool): True if correct, False if incorrect, None if there is no score
+        attempts (int): None if no attempts were recorded, else number of times attempted
     '''
     correct = None
     if 'score' in state:
         if 'raw_earned' in state['score'] and 'raw_possible' in state['score']:
             correct = (state['score']['raw_earned'] == state['score']['raw_possible'])
 
-    if 'attempts' in state:
-        attempts = state['attempts']
-    else:
-        attempts = 0
+    attempts = state.get('attempts')
 
     return (correct, attempts)
 
 
-def is_valid_problem(store, block_key, state, course_blocks):
+def is_valid_problem(correct, course_blocks, block_key, now):
     '''
     Checks a problem to see if it is valid to show to the learner. The
     reason to have this is so learners don't try to cheat by using the
@@ -244,41 +393,57 @@ def is_valid_problem(store, block_key, state, course_blocks):
 
     Required condition to be valid:
         The problem is accessible to the learner (checked through the block
-            structure in the course)
+            structure in the course by the caller before this is called)
 
     Possible conditions to be valid (at least 1 must be true):
-        1) Ungraded (it's ungraded originally so showing it again is okay)
-        2) All attempts have been used. (If all attempts on the actual problem
-            have been used, then it's safe to show them)
-        3) It is past the due date
-        4) Correctly answered (the learner has already correctly answered
+        1) Correctly answered (the learner has already correctly answered
             the problem so it should be fine to show them again.)
+        2) Ungraded (it's ungraded originally so showing it again is okay)
+        3) It is past the due date
+        4) All attempts have been used. (If all attempts on the actual problem
+            have been used, then it's safe to show them)
+
+    The conditions are checked from cheapest to most expensive. Conditions 1
+    to 3 only need the state of the problem and the block structure, so they
+    are checked here. Condition 4 needs the instance of the problem from the
+    modulestore, so it is checked separately by has_used_all_attempts for the
+    accessible problems that fail the conditions here.
 
     Parameters:
-        store (xmodule.modulestore.mixed.MixedModuleStore): Modulestore
-            for grabbing the instance of a problem from the locator key
+        correct (Bool): Whether the learner correctly answered the problem,
+            as returned by get_correctness_and_attempts
+        course_blocks (BlockStructureBlockData): The blocks accessible to the learner
         block_key (opaque_keys.edx.locator.BlockUsageLocator): The locator for the problem
-        state (dict): The state of the problem
+        now (datetime): The current time (timezone aware), used for the due date check
 
     Returns True if the problem is valid, False otherwise
     '''
-    if block_key not in course_blocks:
-        return False
-
-    problem = store.get_item(block_key)
-    if not problem.graded:
+    if correct:
+        return True
+    if not course_blocks.get_xblock_field(block_key, 'graded', False):
+        return True
+    due = course_blocks.get_xblock_field(block_key, 'due')
+    if due is not None and now > due:
         return True
-    if 'attempts' in state:
-        if state['attempts'] == problem.max_attempts:
-            return True
-    if problem.due is not None:
-        now = datetime.utcnow()
-        now = now.replace(tzinfo=pytz.utc)
-        if now > problem.due:
-            return True
-    if 'score' in state:
-        if 'raw_earned' in state['score'] and 'raw_possible' in state['score']:
-            if state['score']['raw_earned'] == state['score']['raw_possible']:
-                return True
 
     return False
+
+
+def has_used_all_attempts(problem, attempts):
+    '''
+    Checks if the learner has used all of the attempts on a problem, which
+    makes it valid to show as review. max_attempts is not collected in the
+    block structure so this needs the instance of the problem.
+
+    Parameters:
+        problem (XModuleDescriptor): The instance of the problem, as returned
+            by get_problem_descriptors (None if it could not be found)
+        attempts (int): The number of attempts the learner has used on the
+            problem, None if no attempts were recorded
+
+    Returns True if all attempts have been used, False otherwise
+    '''
+    # Only attempts that were actually recorded in the state count
+    if problem is None or attempts is None:
+        return False
+    return attempts == problem.max_attempts